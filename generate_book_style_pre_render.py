@@ -5,14 +5,44 @@
 通过两次渲染获取准确的目录页码
 """
 
+import hashlib
+import io
 import json
+import multiprocessing
+import os
 import re
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
 from pathlib import Path
 from jinja2 import Environment, FileSystemLoader
 from weasyprint import HTML
 import pdfplumber
 import qrcode
 
+# PDF后处理优化为可选功能，未安装 pikepdf 时跳过
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+# 子进程内存硬上限，仅 Unix 可用
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 从 .ttc 字体集合中提取单个字形时使用，未安装时改用 local() 引用
+try:
+    from fontTools.ttLib import TTFont
+except ImportError:
+    TTFont = None
+
 def generate_qr_code(url, filename):
     """生成二维码图片"""
     if not url or not url.strip():
@@ -43,15 +73,16 @@ def generate_qr_code(url, filename):
         print(f"  二维码生成失败: {e}")
         return None
 
-def generate_chapter_qr_codes(chapters):
+def generate_chapter_qr_codes(chapters, qr_dir="qr_codes"):
     """为所有章节生成二维码"""
     print("\n[1.5/3] 生成章节二维码...")
     
     # 创建二维码目录
-    qr_dir = Path("qr_codes")
+    qr_dir = Path(qr_dir)
     qr_dir.mkdir(exist_ok=True)
     
     for chapter in chapters:
+        report_progress('qr_codes', chapter['id'])
         if 'qr_link' in chapter and chapter['qr_link']:
             qr_filename = qr_dir / f"chapter_{chapter['id']}_qr.png"
             generated_qr = generate_qr_code(chapter['qr_link'], str(qr_filename))
@@ -574,14 +605,14 @@ def create_pre_render_template():
     
     return template_content
 
-def extract_page_numbers_from_pdf(pdf_path):
-    """从PDF中提取页码信息"""
+def extract_page_numbers_from_pdf(pdf_path, pdf_bytes=None):
+    """从PDF中提取页码信息（提供 pdf_bytes 时直接解析内存中的PDF）"""
     print(f"\n[3/5] 解析PDF提取页码信息: {pdf_path}")
     
     chapter_pages = {}
     
     try:
-        with pdfplumber.open(pdf_path) as pdf:
+        with pdfplumber.open(io.BytesIO(pdf_bytes) if pdf_bytes is not None else pdf_path) as pdf:
             for page_num, page in enumerate(pdf.pages, 1):
                 text = page.extract_text()
                 if text:
@@ -601,18 +632,654 @@ def extract_page_numbers_from_pdf(pdf_path):
     
     return chapter_pages
 
-def generate_book_style_pdf_pre_render():
+# 固定字体映射（部署时运行 --build-font-map 生成一次，各渲染节点只读取）
+FONT_MAP_PATH = "fonts/font-map.json"
+PINNED_FONT_DIR = "fonts/pinned"
+FINAL_TEMPLATE_PATH = "templates/biography_book_style_v3.html"
+FONT_LANG = "zh-cn"
+# CSS font-weight -> fontconfig 字重；模板中的 h2、h3、封面标题使用粗体
+FONT_WEIGHTS = {'normal': 'regular', 'bold': 'bold'}
+FC_WEIGHT_BOLD = 200
+GENERIC_FONT_FAMILIES = {'serif', 'sans-serif', 'monospace', 'cursive', 'fantasy', 'system-ui'}
+
+def collect_font_stacks(css_text):
+    """从CSS中提取 @font-face 定义和所有 font-family 字体栈"""
+    css_text = re.sub(r'/\*.*?\*/', '', css_text, flags=re.S)
+    
+    # @font-face: 字体名 -> 字体文件路径
+    font_faces = {}
+    for block in re.findall(r'@font-face\s*{([^}]*)}', css_text):
+        family = re.search(r"font-family:\s*['\"]?([^'\";]+)['\"]?\s*;", block)
+        src = re.search(r"src:\s*url\(\s*['\"]?([^'\")]+)['\"]?\s*\)", block)
+        if family and src:
+            font_faces[family.group(1).strip()] = src.group(1).strip()
+    
+    # 去掉 @font-face 后再收集字体栈，按出现顺序去重
+    css_text = re.sub(r'@font-face\s*{[^}]*}', '', css_text)
+    stacks = []
+    for value in re.findall(r'font-family:\s*([^;}]+)', css_text):
+        stack = tuple(name.strip().strip('\'"') for name in value.split(',') if name.strip())
+        if stack and stack not in stacks:
+            stacks.append(stack)
+    
+    return font_faces, stacks
+
+def collect_template_fonts(css_texts):
+    """汇总多个模板的 @font-face 定义和字体栈"""
+    font_faces = {}
+    stacks = []
+    for css_text in css_texts:
+        faces, text_stacks = collect_font_stacks(css_text)
+        font_faces.update(faces)
+        for stack in text_stacks:
+            if stack not in stacks:
+                stacks.append(stack)
+    return font_faces, stacks
+
+def template_css_texts():
+    """预渲染模板和最终模板的内容"""
+    return [create_pre_render_template(), Path(FINAL_TEMPLATE_PATH).read_text(encoding='utf-8')]
+
+def system_families(stack, font_faces):
+    """字体栈中交给 fontconfig 解析的字体名（排除本地 @font-face 字体）"""
+    return [family for family in stack if family not in font_faces]
+
+def fc_match_stack(families, weight='regular'):
+    """用 fontconfig 按整个字体栈（附带中文语言提示和字重）查询实际使用的字体"""
+    escaped = [re.sub(r'([\\\-:,])', r'\\\1', family) for family in families]
+    pattern = f"{','.join(escaped)}:lang={FONT_LANG}:weight={weight}"
+    try:
+        result = subprocess.run(
+            ['fc-match', '-f', '%{file}\\n%{index}\\n%{family}\\n%{fullname}\\n%{lang}\\n%{weight}', pattern],
+            capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"  警告：fc-match 查询失败 ({pattern}): {e}")
+        return None
+    
+    lines = result.stdout.split('\n')
+    file, index, family, fullname, langs, weights = (lines + [''] * 6)[:6]
+    if not file:
+        return None
+    
+    # 可变字体的字重输出为范围，如 "[0 210]"
+    weight_values = [float(value) for value in re.findall(r'[\d.]+', weights)]
+    
+    return {
+        'source': file,
+        'index': int(index or 0),
+        'family': family.split(',')[0],
+        'fullname': fullname.split(',')[0],
+        'cjk': FONT_LANG in langs.split('|'),
+        'weight': int(max(weight_values, default=0)),
+    }
+
+@lru_cache(maxsize=None)
+def file_sha256(path):
+    """计算字体文件的 SHA-256，用于校验各节点字体一致"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def pin_font_file(match):
+    """把匹配到的字体复制到 fonts/pinned，集合字体（.ttc）中非首个字形需单独提取"""
+    pinned_dir = Path(PINNED_FONT_DIR)
+    pinned_dir.mkdir(parents=True, exist_ok=True)
+    source = Path(match['source'])
+    prefix = file_sha256(str(source))[:12]
+    
+    if match['index'] == 0:
+        pinned = pinned_dir / f"{prefix}-{source.name}"
+        shutil.copyfile(source, pinned)
+    elif TTFont is not None:
+        pinned = pinned_dir / f"{prefix}-{match['index']}-{source.stem}.ttf"
+        TTFont(str(source), fontNumber=match['index']).save(str(pinned))
+    else:
+        # 无法提取时按字体全名引用，仍只做一次精确匹配
+        print(f"  警告：未安装 fontTools，{source.name} 第 {match['index']} 个字形改用 local('{match['fullname']}')")
+        return None
+    
+    return pinned.as_posix()
+
+def build_font_map(css_texts, map_path=FONT_MAP_PATH):
+    """部署时生成固定字体映射：解析每个字体栈并把字体文件复制到仓库内"""
+    print("\n解析并固定字体映射...")
+    font_faces, stacks = collect_template_fonts(css_texts)
+    
+    stack_map = {}
+    pinned_files = {}
+    for stack in stacks:
+        entry = {'local': None, 'pinned': None}
+        local_family = next((family for family in stack if family in font_faces), None)
+        if local_family:
+            entry['local'] = {
+                'family': local_family,
+                'src': font_faces[local_family],
+                'exists': Path(font_faces[local_family]).exists(),
+            }
+        
+        # 常规和粗体分别解析；没有真正的粗体字形时不固定粗体，由排版时合成
+        entry['pinned'] = {}
+        for css_weight, fc_weight in FONT_WEIGHTS.items():
+            match = fc_match_stack(system_families(stack, font_faces), fc_weight)
+            if match is None or (css_weight == 'bold' and match['weight'] < FC_WEIGHT_BOLD):
+                continue
+            
+            # 只复制含中文字形的字体，同一字形只复制一次
+            match['file'] = None
+            if match['cjk']:
+                key = (match['source'], match['index'])
+                if key not in pinned_files:
+                    pinned_files[key] = pin_font_file(match)
+                match['file'] = pinned_files[key]
+            if match['file']:
+                match['sha256'] = file_sha256(match['file'])
+            entry['pinned'][css_weight] = match
+        stack_map[', '.join(stack)] = entry
+    
+    map_file = Path(map_path)
+    map_file.parent.mkdir(exist_ok=True)
+    with open(map_file, 'w', encoding='utf-8') as f:
+        json.dump({'stacks': stack_map}, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write('\n')
+    print(f"字体映射已写入: {map_path}")
+    
+    report_font_resolution(stack_map, stacks)
+    return stack_map
+
+def load_font_map(map_path=FONT_MAP_PATH):
+    """读取固定字体映射，不存在时返回空映射"""
+    map_file = Path(map_path)
+    if not map_file.exists():
+        print(f"  警告：未找到字体映射 {map_path}，请在部署时运行 --build-font-map")
+        return {}
+    with open(map_file, 'r', encoding='utf-8') as f:
+        return json.load(f).get('stacks', {})
+
+def pinned_font_src(pinned):
+    """固定字体的 @font-face src，文件缺失或内容不一致时返回 None"""
+    if pinned.get('file') is None:
+        return f"local('{pinned['fullname']}')"
+    if not Path(pinned['file']).exists():
+        print(f"  警告：固定字体文件缺失: {pinned['file']}")
+        return None
+    if file_sha256(pinned['file']) != pinned.get('sha256'):
+        print(f"  警告：固定字体文件与映射不一致（SHA-256 不同）: {pinned['file']}")
+        return None
+    return f"url('{pinned['file']}')"
+
+def report_font_resolution(stack_map, stacks):
+    """输出每个字体栈实际使用的字体"""
+    for stack in stacks:
+        stack_text = ', '.join(stack)
+        entry = stack_map.get(stack_text)
+        local = entry and entry['local']
+        pinned = entry and entry['pinned']
+        if entry is None:
+            print(f"  {stack_text} -> 不在字体映射中")
+        elif local and Path(local['src']).exists():
+            print(f"  {stack_text} -> {local['family']} ({local['src']})")
+        elif pinned:
+            for css_weight in FONT_WEIGHTS:
+                match = pinned.get(css_weight)
+                if match is None:
+                    print(f"  {stack_text} [{css_weight}] -> 无真正的粗体字形，未固定")
+                    continue
+                note = "" if match['cjk'] else "，不含中文字形，未固定"
+                print(f"  {stack_text} [{css_weight}] -> {match['family']} ({match['source']}#{match['index']}{note})")
+        else:
+            print(f"  {stack_text} -> 无法解析")
+
+def create_font_face_css(stack_map, stacks, font_faces):
+    """为字体栈中的系统字体名生成固定的 @font-face 规则，避免排版时反复回退查找
+
+    本地 @font-face 字体从不固定；固定字体不含中文字形时不注入；常规和粗体各一条规则。
+    """
+    rules = []
+    pinned_families = set()
+    for stack in stacks:
+        entry = stack_map.get(', '.join(stack))
+        if entry is None:
+            continue
+        
+        local = entry['local']
+        if local and local['exists'] != Path(local['src']).exists():
+            print(f"  警告：{local['src']} 已变化，字体映射已过期，请重新运行 --build-font-map")
+        
+        for css_weight, match in sorted(entry['pinned'].items()):
+            if not match['cjk']:
+                continue
+            src = pinned_font_src(match)
+            if src is None:
+                continue
+            
+            for family in system_families(stack, font_faces):
+                if family in GENERIC_FONT_FAMILIES or (family, css_weight) in pinned_families:
+                    continue
+                pinned_families.add((family, css_weight))
+                rules.append(
+                    "@font-face {\n"
+                    f"    font-family: '{family}';\n"
+                    f"    src: {src};\n"
+                    f"    font-weight: {css_weight};\n"
+                    "}"
+                )
+    return '\n'.join(rules)
+
+def inject_font_faces(html_content, font_face_css):
+    """将固定字体规则插入到 </head> 之前"""
+    if not font_face_css:
+        return html_content
+    return html_content.replace('</head>', f'<style>\n{font_face_css}\n</style>\n</head>', 1)
+
+def resolve_fonts(css_texts):
+    """字体解析：读取部署时生成的固定映射，生成 @font-face 规则"""
+    print("\n[1.6/5] 读取字体映射...")
+    
+    font_faces, stacks = collect_template_fonts(css_texts)
+    stack_map = load_font_map()
+    report_font_resolution(stack_map, stacks)
+    
+    print("字体解析完成")
+    return create_font_face_css(stack_map, stacks, font_faces)
+
+class JobFailure(Exception):
+    """任务失败，记录失败原因、所在阶段和章节"""
+    
+    def __init__(self, reason, stage=None, chapter=None, detail=''):
+        super().__init__(detail or reason)
+        self.reason = reason
+        self.stage = stage
+        self.chapter = chapter
+        self.detail = detail
+    
+    def to_dict(self):
+        return {
+            'reason': self.reason,
+            'stage': self.stage,
+            'chapter': self.chapter,
+            'detail': self.detail,
+        }
+
+# 子进程中的进度队列（由 run_job_worker 设置），以及各阶段最近处理的章节
+_progress_queue = None
+_stage_chapters = {}
+
+def report_progress(stage, chapter=None, done=False):
+    """上报阶段进度，供资源管控进程定位失败的阶段和章节"""
+    if not done:
+        _stage_chapters[stage] = chapter
+    if _progress_queue is not None:
+        _progress_queue.put(('progress', stage, chapter, done))
+
+def run_stage_graph(stages, max_workers=4, cancel_event=None):
+    """按依赖关系并发执行各阶段
+
+    stages: 阶段名 -> (函数, 依赖阶段名列表)，函数接收已完成阶段的结果字典。
+    cancel_event 被设置后不再启动新阶段（协作式取消）。
+    返回 (结果字典, 计时字典)，计时为 阶段名 -> (开始, 结束) 的相对秒数。
+    """
+    results = {}
+    timings = {}
+    pending = dict(stages)
+    running = {}
+    start = time.perf_counter()
+    
+    def run_stage(name, func):
+        stage_start = time.perf_counter() - start
+        report_progress(name)
+        value = func(results)
+        report_progress(name, done=True)
+        return value, (stage_start, time.perf_counter() - start)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # 提交所有依赖已完成的阶段
+            for name, (func, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    if cancel_event is not None and cancel_event.is_set():
+                        for other in running:
+                            other.cancel()
+                        raise JobFailure('cancelled', name, detail="任务已取消")
+                    running[executor.submit(run_stage, name, func)] = name
+                    del pending[name]
+            
+            if not running:
+                raise RuntimeError(f"阶段依赖无法满足: {', '.join(pending)}")
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name], timings[name] = future.result()
+                except Exception as e:
+                    for other in running:
+                        other.cancel()
+                    print(f"阶段失败: {name}")
+                    if isinstance(e, JobFailure):
+                        raise
+                    if isinstance(e, MemoryError):
+                        raise JobFailure('memory', name, _stage_chapters.get(name), "内存分配失败（超出进程内存硬上限）") from e
+                    raise JobFailure('error', name, _stage_chapters.get(name), f"{type(e).__name__}: {e}") from e
+    
+    return results, timings
+
+def report_critical_path(stages, timings):
+    """输出各阶段耗时和关键路径"""
+    print("\n阶段耗时：")
+    for name, (stage_start, stage_end) in sorted(timings.items(), key=lambda item: item[1][0]):
+        print(f"  {name:<20} {stage_start:7.2f}s -> {stage_end:7.2f}s  ({stage_end - stage_start:.2f}s)")
+    
+    # 从最后结束的阶段沿最晚完成的依赖回溯
+    path = [max(timings, key=lambda name: timings[name][1])]
+    while stages[path[-1]][1]:
+        path.append(max(stages[path[-1]][1], key=lambda name: timings[name][1]))
+    path.reverse()
+    
+    busy = sum(timings[name][1] - timings[name][0] for name in path)
+    wall = max(stage_end for _, stage_end in timings.values())
+    serial = sum(stage_end - stage_start for stage_start, stage_end in timings.values())
+    print(f"关键路径: {' -> '.join(path)} ({busy:.2f}s)")
+    print(f"总耗时: {wall:.2f}s (串行执行约 {serial:.2f}s)")
+
+def validate_book_data(book_data, limits=None):
+    """校验书籍数据的必需字段，以及段落长度和本地图片大小是否超出限制"""
+    limits = limits or DEFAULT_JOB_LIMITS
+    
+    missing = [key for key in ('title', 'author') if key not in book_data.get('book_info', {})]
+    if missing:
+        raise JobFailure('invalid_input', 'validate', detail=f"book_info 缺少字段: {', '.join(missing)}")
+    
+    for chapter in book_data.get('chapters', []):
+        chapter_id = chapter.get('id')
+        missing = [key for key in ('id', 'title', 'content') if key not in chapter]
+        if missing:
+            raise JobFailure('invalid_input', 'validate', chapter_id, f"缺少字段: {', '.join(missing)}")
+        
+        for paragraph in chapter['content']:
+            if len(paragraph) > limits['max_paragraph_chars']:
+                raise JobFailure('invalid_input', 'validate', chapter_id,
+                                 f"段落长度 {len(paragraph)} 超过上限 {limits['max_paragraph_chars']}")
+        
+        for image in chapter.get('images') or []:
+            image_path = Path(image['url'] if isinstance(image, dict) else image)
+            if image_path.is_file() and image_path.stat().st_size > limits['max_image_mb'] * 1024 * 1024:
+                raise JobFailure('invalid_input', 'validate', chapter_id,
+                                 f"图片 {image_path} 超过 {limits['max_image_mb']} MB")
+
+# 单个任务的默认资源限制，可通过环境变量覆盖
+DEFAULT_JOB_LIMITS = {
+    'timeout': float(os.environ.get('BOOK_JOB_TIMEOUT', 600)),     # 墙钟超时（秒）
+    'max_rss_mb': int(os.environ.get('BOOK_JOB_MAX_RSS_MB', 2048)), # 内存上限（MB），同时是声明的内存预算
+    'cpus': int(os.environ.get('BOOK_JOB_CPUS', 1)),               # 声明占用的CPU数
+    'cancel_grace': 10,          # 取消后等待任务自行退出的时间（秒）
+    'max_paragraph_chars': 20000,
+    'max_image_mb': 20,
+    'rlimit_headroom': 1.5,      # 进程数据段硬上限 = max_rss_mb × 该倍数，兜住两次轮询之间的内存暴涨
+}
+
+def layout_scope(chapters):
+    """WeasyPrint 排版过程中无法定位到具体章节，返回章节范围和最长段落所在章节"""
+    if not chapters:
+        return None
+    longest = max(chapters, key=lambda chapter: max(map(len, chapter['content']), default=0))
+    longest_chars = max(map(len, longest['content']), default=0)
+    return f"第{chapters[0]['id']}-{chapters[-1]['id']}篇（最长段落在第{longest['id']}篇，{longest_chars}字）"
+
+def make_job(name, json_path, pre_render_pdf_path, output_pdf_path, qr_dir="qr_codes",
+             post_optimize=os.environ.get('BOOK_OPTIMIZE_PDF') == '1',
+             linearize=os.environ.get('BOOK_LINEARIZE_PDF') == '1', **limits):
+    """创建任务配置，未指定的资源限制使用默认值"""
+    job = {
+        'name': name,
+        'json_path': json_path,
+        'pre_render_pdf_path': pre_render_pdf_path,
+        'output_pdf_path': output_pdf_path,
+        'qr_dir': qr_dir,
+        'post_optimize': post_optimize,
+        'linearize': linearize,
+    }
+    job.update(DEFAULT_JOB_LIMITS)
+    job.update(limits)
+    return job
+
+DEFAULT_JOB = make_job(
+    "new回忆录",
+    "new-instance.json",
+    "output/new回忆录_预渲染版.pdf",
+    "output/new回忆录_Book风格_v3_预渲染终极版.pdf",
+)
+
+def hash_pdf_object(obj, digest, seen):
+    """递归地把PDF对象内容写入摘要，引用的流（如 /SMask、/DecodeParms）按内容而非对象号计入"""
+    if isinstance(obj, pikepdf.Object) and obj.is_indirect:
+        if obj.objgen in seen:
+            digest.update(f"ref{obj.objgen}".encode('utf-8'))
+            return
+        seen = seen | {obj.objgen}
+    
+    if isinstance(obj, pikepdf.Stream):
+        digest.update(b'stream')
+        digest.update(obj.read_raw_bytes())
+        items = [(key, value) for key, value in obj.stream_dict.items() if key != '/Length']
+    elif isinstance(obj, pikepdf.Dictionary):
+        digest.update(b'dict')
+        items = list(obj.items())
+    elif isinstance(obj, pikepdf.Array):
+        digest.update(b'array')
+        items = list(enumerate(obj))
+    else:
+        digest.update(repr(obj).encode('utf-8'))
+        return
+    
+    for key, value in sorted(items, key=lambda item: str(item[0])):
+        digest.update(str(key).encode('utf-8'))
+        hash_pdf_object(value, digest, seen)
+
+def pdf_stream_key(stream):
+    """按流内容和字典（不含 /Length）计算去重键"""
+    digest = hashlib.sha256()
+    hash_pdf_object(stream, digest, frozenset())
+    return digest.hexdigest()
+
+def unique_resource_dicts(pdf):
+    """页面和表单 XObject 使用的资源字典，共用的字典只返回一次"""
+    owners = [page.obj for page in pdf.pages]
+    owners += [obj for obj in pdf.objects if isinstance(obj, pikepdf.Stream) and obj.get('/Subtype') == '/Form']
+    
+    seen = set()
+    resource_dicts = []
+    for owner in owners:
+        resources = owner.get('/Resources')
+        if resources is None:
+            continue
+        key = resources.objgen if resources.is_indirect else ('owner', owner.objgen)
+        if key not in seen:
+            seen.add(key)
+            resource_dicts.append(resources)
+    return resource_dicts
+
+def merge_duplicate_resources(pdf):
+    """合并内容相同的图片和嵌入字体文件，返回合并的数量"""
+    canonical = {}
+    stream_keys = {}
+    merged = 0
+    
+    def merge(container, key):
+        nonlocal merged
+        stream = container[key]
+        if stream.objgen not in stream_keys:
+            stream_keys[stream.objgen] = pdf_stream_key(stream)
+        first = canonical.setdefault(stream_keys[stream.objgen], stream)
+        if first.objgen != stream.objgen:
+            container[key] = first
+            merged += 1
+    
+    for resources in unique_resource_dicts(pdf):
+        xobjects = resources.get('/XObject', {})
+        for name in list(xobjects.keys()):
+            if xobjects[name].get('/Subtype') == '/Image':
+                merge(xobjects, name)
+        
+        for font in resources.get('/Font', {}).values():
+            descriptors = [font.get('/FontDescriptor')]
+            descriptors += [descendant.get('/FontDescriptor') for descendant in font.get('/DescendantFonts', [])]
+            for descriptor in descriptors:
+                if descriptor is None:
+                    continue
+                for file_key in ('/FontFile', '/FontFile2', '/FontFile3'):
+                    if file_key in descriptor:
+                        merge(descriptor, file_key)
+    
+    return merged
+
+def content_stream_names(streams):
+    """收集内容流中出现的所有名称"""
+    names = set()
+    for stream in streams:
+        names.update(re.findall(rb'/([^\s/\[\]()<>{}%]+)', stream.read_bytes()))
+    return names
+
+RESOURCE_CATEGORIES = ('/XObject', '/Font', '/ExtGState', '/Pattern', '/Shading', '/ColorSpace', '/Properties')
+
+def resource_owners(pdf):
+    """列出所有带内容流的对象及其资源字典：页面、表单 XObject、平铺图案和 Type3 字体
+
+    返回 (内容流列表, 资源字典或 None) 的列表。
+    """
+    owners = []
+    for page in pdf.pages:
+        contents = page.obj.get('/Contents')
+        streams = [] if contents is None else list(contents) if isinstance(contents, pikepdf.Array) else [contents]
+        owners.append((streams, page.obj.get('/Resources')))
+    
+    for obj in pdf.objects:
+        if isinstance(obj, pikepdf.Stream) and (obj.get('/Subtype') == '/Form' or obj.get('/PatternType') == 1):
+            owners.append(([obj], obj.get('/Resources')))
+    
+    # Type3 字体的字形过程（CharProcs）也是内容流，可能是资源字典中的直接对象，逐层查找
+    seen_fonts = set()
+    index = 0
+    while index < len(owners):
+        resources = owners[index][1]
+        index += 1
+        if resources is None:
+            continue
+        for font in resources.get('/Font', {}).values():
+            if font.get('/Subtype') != '/Type3':
+                continue
+            if font.is_indirect:
+                if font.objgen in seen_fonts:
+                    continue
+                seen_fonts.add(font.objgen)
+            owners.append((list(font.get('/CharProcs', {}).values()), font.get('/Resources')))
+    
+    return owners
+
+def strip_unused_resources(pdf):
+    """删除所有内容流都未使用的资源，返回删除的数量
+
+    WeasyPrint 的页面、透明度组和图案共用同一个 /Font 等分类字典，pikepdf 的
+    remove_unreferenced_resources() 会为每页复制一份资源字典反而增大文件。这里按分类字典
+    本身归组，汇总能访问到它的所有内容流中出现的名称后再删除。
+    """
+    groups = {}
+    inherited_names = set()
+    for owner_index, (streams, resources) in enumerate(resource_owners(pdf)):
+        names = content_stream_names(streams)
+        if resources is None:
+            # 没有自带资源的内容流沿用上层资源，保守起见计入所有分组
+            inherited_names |= names
+            continue
+        
+        resources_key = resources.objgen if resources.is_indirect else ('owner', owner_index)
+        for category in RESOURCE_CATEGORIES:
+            entries = resources.get(category)
+            if entries is None:
+                continue
+            key = entries.objgen if entries.is_indirect else (resources_key, category)
+            group = groups.setdefault(key, {'entries': entries, 'names': set()})
+            group['names'] |= names
+    
+    removed = 0
+    for group in groups.values():
+        used = group['names'] | inherited_names
+        entries = group['entries']
+        for name in list(entries.keys()):
+            if name[1:].encode('utf-8') not in used:
+                del entries[name]
+                removed += 1
+    
+    return removed
+
+def optimize_pdf(pdf_path, linearize=False):
+    """PDF后处理：合并重复资源、删除未引用资源、压缩为对象流并线性化（快速网页显示）
+
+    结果不比原文件小时保留原文件，除非明确要求线性化（linearize=True）。
+    """
+    print(f"\n[后处理] PDF优化: {pdf_path}")
+    if pikepdf is None:
+        print("  未安装 pikepdf，跳过PDF优化 (pip install pikepdf)")
+        return None
+    
+    start = time.perf_counter()
+    pdf_file = Path(pdf_path)
+    size_before = pdf_file.stat().st_size
+    tmp_file = pdf_file.with_name(f"{pdf_file.stem}.{os.getpid()}.tmp.pdf")
+    
+    # 后处理失败不影响已生成的PDF：清理临时文件并保留原文件
+    try:
+        with pikepdf.open(pdf_file) as pdf:
+            merged = merge_duplicate_resources(pdf)
+            removed = strip_unused_resources(pdf)
+            pdf.save(
+                tmp_file,
+                linearize=linearize,
+                compress_streams=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            )
+        
+        size_after = tmp_file.stat().st_size
+        kept = size_after >= size_before and not linearize
+        if not kept:
+            os.replace(tmp_file, pdf_file)
+    except Exception as e:
+        print(f"  警告：PDF优化失败，保留原文件: {e}")
+        return None
+    finally:
+        tmp_file.unlink(missing_ok=True)
+    
+    elapsed = time.perf_counter() - start
+    print(f"  合并重复资源: {merged} 个，删除未使用资源: {removed} 个")
+    print(f"  文件大小: {size_before / 1024:.2f} KB -> {size_after / 1024:.2f} KB "
+          f"({(size_after - size_before) / size_before:+.1%})，耗时 {elapsed:.2f}s")
+    if kept:
+        print("  优化后文件未变小，保留原文件")
+    
+    return {
+        'kept_original': kept,
+        'size_before': size_before,
+        'size_after': size_after,
+        'merged': merged,
+        'removed': removed,
+        'elapsed': elapsed,
+    }
+
+def generate_book_style_pdf_pre_render(job=None, cancel_event=None):
     """使用预渲染分页计算方案生成传记PDF"""
+    job = job or DEFAULT_JOB
     
     print("=" * 60)
     print("使用预渲染分页计算方案生成传记 PDF (终极方案)")
     print("=" * 60)
     
     # 配置文件路径
-    JSON_PATH = "new-instance.json"
-    TEMPLATE_PATH = "templates/biography_book_style_v3.html"
-    PRE_RENDER_PDF_PATH = "output/new回忆录_预渲染版.pdf"
-    OUTPUT_PDF_PATH = "output/new回忆录_Book风格_v3_预渲染终极版.pdf"
+    JSON_PATH = job['json_path']
+    TEMPLATE_PATH = FINAL_TEMPLATE_PATH
+    PRE_RENDER_PDF_PATH = job['pre_render_pdf_path']
+    OUTPUT_PDF_PATH = job['output_pdf_path']
     
     # 创建输出目录
     output_dir = Path("output")
@@ -622,75 +1289,91 @@ def generate_book_style_pdf_pre_render():
     template_dir = Path("templates")
     template_dir.mkdir(exist_ok=True)
     
-    try:
+    base_url = str(Path(".").absolute())
+    pre_render_template = create_pre_render_template()
+    
+    def load_json(results):
         # 1. 读取 JSON 数据
         print(f"\n[1/5] 读取 JSON 数据: {JSON_PATH}")
         with open(JSON_PATH, 'r', encoding='utf-8') as f:
             book_data = json.load(f)
         print(f"成功读取数据：{book_data['book_info']['title']}")
-        
-        generate_chapter_qr_codes(book_data['chapters'])
+        return book_data
+    
+    def validate(results):
+        book_data = results['load_json']
+        validate_book_data(book_data, job)
         # 显示目录信息
         print("\n目录信息：")
         for chapter in book_data['chapters']:
             print(f"  第{chapter['id']}篇 {chapter['title']}")
-        
+    
+    def qr_codes(results):
+        generate_chapter_qr_codes(results['load_json']['chapters'], job['qr_dir'])
+    
+    def load_final_template(results):
+        # 加载最终模板
+        template_file = Path(TEMPLATE_PATH)
+        env = Environment(loader=FileSystemLoader(str(template_file.parent)))
+        return env.get_template(template_file.name)
+    
+    def fonts(results):
+        # 字体解析（预渲染模板与最终模板共用同一份固定映射）
+        return resolve_fonts(template_css_texts())
+    
+    def pre_render_pdf(results):
         # 2. 第一次渲染（预渲染，无目录，带页码标记）
         print(f"\n[2/5] 第一次渲染（预渲染，带页码标记）...")
-        
-        # 创建预渲染模板
-        pre_render_template = create_pre_render_template()
+        report_progress('pre_render_pdf', layout_scope(results['load_json']['chapters']))
         
         # 使用Jinja2渲染预渲染模板
         env = Environment(loader=FileSystemLoader('.'))
         template = env.from_string(pre_render_template)
-        html_content_pre = template.render(**book_data)
+        html_content_pre = inject_font_faces(template.render(**results['load_json']), results['fonts'])
         
-        # 生成预渲染PDF
-        base_url = str(Path(".").absolute())
+        # 生成预渲染PDF（保留在内存中，写盘在后台进行）
         html_obj_pre = HTML(string=html_content_pre, base_url=base_url)
-        
-        html_obj_pre.write_pdf(
-            PRE_RENDER_PDF_PATH,
+        return html_obj_pre.write_pdf(
             optimize_images=True,
             jpeg_quality=95,
             dpi=300,
             presentational_hints=True
         )
+    
+    def write_pre_render(results):
+        Path(PRE_RENDER_PDF_PATH).write_bytes(results['pre_render_pdf'])
         print(f"预渲染PDF生成成功: {PRE_RENDER_PDF_PATH}")
-        
+    
+    def page_numbers(results):
         # 3. 解析预渲染PDF，提取页码信息
-        chapter_pages = extract_page_numbers_from_pdf(PRE_RENDER_PDF_PATH)
+        chapter_pages = extract_page_numbers_from_pdf(PRE_RENDER_PDF_PATH, results['pre_render_pdf'])
         
         # 4. 更新章节数据中的页码
         print(f"\n[4/5] 更新章节页码数据...")
-        for i, chapter in enumerate(book_data['chapters'], 1):
+        for i, chapter in enumerate(results['load_json']['chapters'], 1):
             if i in chapter_pages:
                 chapter['page'] = chapter_pages[i]
                 print(f"  更新：第{chapter['id']}篇 -> 页码 {chapter['page']}")
-        
+    
+    def final_html(results):
         # 5. 第二次渲染（最终版本，包含准确页码的目录）
         print(f"\n[5/5] 第二次渲染（最终版本，包含准确目录）...")
         
-        # 加载最终模板
-        template_file = Path(TEMPLATE_PATH)
-        template_dir = str(template_file.parent)
-        template_name = template_file.name
-        
-        env = Environment(loader=FileSystemLoader(template_dir))
-        template = env.get_template(template_name)
-        
         # 渲染最终HTML
-        html_content_final = template.render(**book_data)
-        
+        template = results['load_final_template']
+        return inject_font_faces(template.render(**results['load_json']), results['fonts'])
+    
+    def write_debug_html(results):
         # 保存调试 HTML
         debug_html_path = OUTPUT_PDF_PATH.replace('.pdf', '_debug.html')
         with open(debug_html_path, 'w', encoding='utf-8') as f:
-            f.write(html_content_final)
+            f.write(results['final_html'])
         print(f"调试 HTML 已保存: {debug_html_path}")
-        
+    
+    def final_pdf(results):
         # 生成最终PDF
-        html_obj_final = HTML(string=html_content_final, base_url=base_url)
+        report_progress('final_pdf', layout_scope(results['load_json']['chapters']))
+        html_obj_final = HTML(string=results['final_html'], base_url=base_url)
         
         html_obj_final.write_pdf(
             OUTPUT_PDF_PATH,
@@ -701,6 +1384,27 @@ def generate_book_style_pdf_pre_render():
         )
         
         print(f"最终PDF生成成功!")
+    
+    # 阶段依赖图：阶段名 -> (函数, 依赖阶段)
+    stages = {
+        'load_json': (load_json, []),
+        'validate': (validate, ['load_json']),
+        'qr_codes': (qr_codes, ['load_json']),
+        'load_final_template': (load_final_template, []),
+        'fonts': (fonts, []),
+        'pre_render_pdf': (pre_render_pdf, ['validate', 'qr_codes', 'fonts']),
+        'write_pre_render': (write_pre_render, ['pre_render_pdf']),
+        'page_numbers': (page_numbers, ['pre_render_pdf']),
+        'final_html': (final_html, ['page_numbers', 'load_final_template']),
+        'write_debug_html': (write_debug_html, ['final_html']),
+        'final_pdf': (final_pdf, ['final_html']),
+    }
+    if job['post_optimize']:
+        stages['optimize_pdf'] = (lambda results: optimize_pdf(OUTPUT_PDF_PATH, job['linearize']), ['final_pdf'])
+    
+    try:
+        results, timings = run_stage_graph(stages, cancel_event=cancel_event)
+        report_critical_path(stages, timings)
         
         print(f"\n任务完成!")
         print(f"预渲染PDF路径: {Path(PRE_RENDER_PDF_PATH).absolute()}")
@@ -719,11 +1423,239 @@ def generate_book_style_pdf_pre_render():
         print(f"生成失败: {e}")
         import traceback
         traceback.print_exc()
+        failure = e if isinstance(e, JobFailure) else JobFailure('error', detail=f"{type(e).__name__}: {e}")
+        if _progress_queue is not None:
+            _progress_queue.put(('failed', failure.to_dict()))
         return False
 
+def read_meminfo_mb(field):
+    """读取 /proc/meminfo 中的内存字段（MB），无法读取时返回 None"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+def read_node_budget():
+    """读取节点资源预算（内存MB、CPU数），可通过环境变量覆盖
+
+    内存预算取节点总内存，用于拒绝任何时候都放不下的任务；
+    当前可用内存只用于决定是否等待其他任务结束后再启动。
+    """
+    memory_mb = os.environ.get('BOOK_NODE_MEMORY_MB')
+    if memory_mb is None:
+        memory_mb = read_meminfo_mb('MemTotal') or 4096
+    
+    return {
+        'memory_mb': int(memory_mb),
+        'cpus': int(os.environ.get('BOOK_NODE_CPUS', os.cpu_count() or 1)),
+    }
+
+def read_rss_mb(pid):
+    """读取进程当前常驻内存（MB），无法读取时返回 None"""
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def run_job_worker(job, cancel_event, progress_queue):
+    """子进程入口：执行单个任务并通过队列回传进度和结果"""
+    global _progress_queue
+    _progress_queue = progress_queue
+    
+    # Ctrl-C 由主进程统一处理，子进程通过 cancel_event 协作式取消
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, 'pthread_sigmask'):
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGINT})
+    
+    # 内存硬上限：主进程轮询 RSS 之外的兜底
+    if resource is not None:
+        limit = int(job['max_rss_mb'] * job['rlimit_headroom'] * 1024 * 1024)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+    
+    success = generate_book_style_pdf_pre_render(job, cancel_event)
+    progress_queue.put(('result', success))
+
+def current_stage(run):
+    """返回任务最近开始且仍在执行的阶段及其章节"""
+    if run['active']:
+        return list(run['active'].items())[-1]
+    return run['last_stage']
+
+def stop_job(run, reason, detail, hard=False):
+    """请求停止任务：先协作式取消，超过宽限时间后强制终止"""
+    stage, chapter = current_stage(run)
+    run['limit_failure'] = JobFailure(reason, stage, chapter, detail).to_dict()
+    run['cancel_event'].set()
+    run['kill_at'] = time.monotonic() + (0 if hard else run['job']['cancel_grace'])
+    print(f"  [{run['job']['name']}] 停止任务: {detail}")
+
+def poll_job(run):
+    """读取任务进度并检查超时、内存和取消状态"""
+    while not run['queue'].empty():
+        message = run['queue'].get()
+        if message[0] == 'progress':
+            _, stage, chapter, done = message
+            if done:
+                run['active'].pop(stage, None)
+            else:
+                run['active'][stage] = chapter
+                run['last_stage'] = (stage, chapter)
+        elif message[0] == 'failed':
+            run['failure'] = message[1]
+        elif message[0] == 'result':
+            run['success'] = message[1]
+    
+    process = run['process']
+    if not process.is_alive():
+        return
+    
+    job = run['job']
+    elapsed = time.monotonic() - run['start']
+    rss_mb = read_rss_mb(process.pid)
+    if rss_mb is not None:
+        run['peak_rss_mb'] = max(run['peak_rss_mb'], rss_mb)
+    elif not run['rss_warned']:
+        run['rss_warned'] = True
+        backstop = "仅依靠进程内存硬上限" if resource is not None else "内存上限不生效"
+        print(f"  [{job['name']}] 警告：无法读取进程内存占用，{backstop}")
+    
+    if run['kill_at'] is None:
+        if elapsed > job['timeout']:
+            stop_job(run, 'timeout', f"运行 {elapsed:.1f}s 超过超时 {job['timeout']:.0f}s")
+        elif rss_mb is not None and rss_mb > job['max_rss_mb']:
+            stop_job(run, 'memory', f"内存 {rss_mb:.0f} MB 超过上限 {job['max_rss_mb']} MB", hard=True)
+    elif time.monotonic() >= run['kill_at']:
+        if run['kill_at'] + 5 < time.monotonic():
+            process.kill()
+        else:
+            process.terminate()
+
+def finish_job(run):
+    """汇总已退出任务的结果"""
+    if run['process'].pid is not None:
+        run['process'].join()
+    poll_job(run)
+    
+    failure = run['limit_failure'] or run['failure']
+    if failure is None and not run['success']:
+        stage, chapter = current_stage(run)
+        failure = JobFailure('crashed', stage, chapter, f"子进程退出码 {run['process'].exitcode}").to_dict()
+    
+    return {
+        'name': run['job']['name'],
+        'ok': failure is None,
+        'elapsed': time.monotonic() - run['start'],
+        'peak_rss_mb': run['peak_rss_mb'],
+        'failure': failure,
+    }
+
+@contextmanager
+def sigint_blocked():
+    """在代码块执行期间屏蔽 SIGINT，Ctrl-C 在代码块结束后才生效"""
+    old_mask = None
+    if hasattr(signal, 'pthread_sigmask'):
+        old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT})
+    try:
+        yield
+    finally:
+        if old_mask is not None:
+            signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+def run_jobs(jobs, budget=None, poll_interval=0.5):
+    """在独立子进程中执行任务，按声明的资源预算（而非固定进程数）控制并发"""
+    budget = budget or read_node_budget()
+    print(f"节点资源预算: 内存 {budget['memory_mb']} MB, CPU {budget['cpus']}")
+    
+    pending = list(jobs)
+    running = []
+    results = []
+    cancelled = False
+    
+    while pending or running:
+        try:
+            # 按顺序启动预算内可容纳的任务
+            while pending and not cancelled:
+                job = pending[0]
+                if job['max_rss_mb'] > budget['memory_mb'] or job['cpus'] > budget['cpus']:
+                    pending.pop(0)
+                    failure = JobFailure('over_budget', detail=f"任务声明的资源超出节点预算: 内存 {job['max_rss_mb']} MB, CPU {job['cpus']}")
+                    results.append({'name': job['name'], 'ok': False, 'elapsed': 0, 'peak_rss_mb': 0, 'failure': failure.to_dict()})
+                    continue
+                
+                used_memory = sum(run['job']['max_rss_mb'] for run in running)
+                used_cpus = sum(run['job']['cpus'] for run in running)
+                if used_memory + job['max_rss_mb'] > budget['memory_mb'] or used_cpus + job['cpus'] > budget['cpus']:
+                    break
+                
+                # 已有任务在运行且当前可用内存不足时，等其他任务结束再启动
+                available_mb = read_meminfo_mb('MemAvailable')
+                if running and available_mb is not None and available_mb < job['max_rss_mb']:
+                    break
+                
+                # 启动期间屏蔽 SIGINT，保证任务要么仍在 pending，要么已记入 running；
+                # 子进程继承屏蔽状态，在 run_job_worker 中改为忽略
+                with sigint_blocked():
+                    pending.pop(0)
+                    cancel_event = multiprocessing.Event()
+                    queue = multiprocessing.Queue()
+                    process = multiprocessing.Process(target=run_job_worker, args=(job, cancel_event, queue), name=job['name'])
+                    running.append({
+                        'job': job, 'process': process, 'queue': queue, 'cancel_event': cancel_event,
+                        'start': time.monotonic(), 'active': {}, 'last_stage': (None, None),
+                        'peak_rss_mb': 0, 'rss_warned': False, 'kill_at': None, 'limit_failure': None,
+                        'failure': None, 'success': None,
+                    })
+                    process.start()
+                print(f"启动任务: {job['name']} (pid {process.pid})")
+            
+            time.sleep(poll_interval)
+            for run in list(running):
+                poll_job(run)
+                if not run['process'].is_alive():
+                    # 先记录结果再移出 running，期间屏蔽 SIGINT，避免任务丢失结果
+                    with sigint_blocked():
+                        results.append(finish_job(run))
+                        running.remove(run)
+        
+        except KeyboardInterrupt:
+            # 取消所有任务：未启动的直接记为取消，运行中的先协作式取消
+            cancelled = True
+            for job in pending:
+                failure = JobFailure('cancelled', detail="任务未启动即被取消")
+                results.append({'name': job['name'], 'ok': False, 'elapsed': 0, 'peak_rss_mb': 0, 'failure': failure.to_dict()})
+            pending = []
+            for run in running:
+                if run['kill_at'] is None:
+                    stop_job(run, 'cancelled', "任务已取消")
+    
+    print("\n任务结果：")
+    for result in results:
+        if result['ok']:
+            print(f"  {result['name']}: 成功 ({result['elapsed']:.1f}s, 峰值内存 {result['peak_rss_mb']:.0f} MB)")
+        else:
+            failure = result['failure']
+            print(f"  {result['name']}: 失败 [{failure['reason']}] 阶段 {failure['stage'] or '-'}, "
+                  f"章节 {failure['chapter'] if failure['chapter'] is not None else '-'}: {failure['detail']}")
+    
+    return results
+
 def main():
     """主函数"""
-    success = generate_book_style_pdf_pre_render()
+    if '--build-font-map' in sys.argv[1:]:
+        # 部署时运行一次，生成 fonts/font-map.json 和 fonts/pinned/
+        build_font_map(template_css_texts())
+        return
+    
+    results = run_jobs([DEFAULT_JOB])
+    success = all(result['ok'] for result in results)
     
     if success:
         print("\n结束处理")